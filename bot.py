@@ -1,31 +1,50 @@
 import datetime
+import html
 import logging
+import msgspec
 import os
-import pickle
+import re
+import signal
+import sys
 import time
-import pytz
-from urllib.request import urlopen
-from urllib.parse import urlencode
+import requests
+import requests.adapters
+from concurrent.futures import ThreadPoolExecutor
 
-from bs4 import BeautifulSoup
 from enum import Enum
-
-import twitter
-from twitter.error import TwitterError
+from typing import Optional
+from zoneinfo import ZoneInfo
 
 class Line:
+    __slots__ = ('name', 'emoji', 'key')
+
     def __init__(self, name, emoji):
         self.name = name
         self.emoji = emoji
+        self.key = name.lower()
+
+class MLStatus(msgspec.Struct):
+    message: str
+    ok: bool
 
-class MLStatus:
-    def __init__(self, message, ok):
-        self.message = message
-        self.ok = ok
+class MLState(msgspec.Struct, forbid_unknown_fields=True):
+    status: dict[str, MLStatus] = {}
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
 
 class MLBot:
     TIMEZONE = 'Europe/Lisbon'
     STATUS_URL = 'http://app.metrolisboa.pt/status/estado_Linhas.php'
+
+    # <td class="linha_X"> followed by its first <li>; the attributes of
+    # the <li>'s parent are captured (the <td> itself if there is no wrapper)
+    STATUS_RE = re.compile(
+        rb'<td([^>]*\blinha_(\w+)[^>]*)>'
+        rb'(?:.*?<\w+([^>]*)>)??\s*'
+        rb'<li[^>]*>(.*?)</li>',
+        re.DOTALL | re.IGNORECASE)
+    TAG_RE = re.compile(rb'<[^>]*>')
+    CLASS_RE = re.compile(rb'\bclass\s*=\s*(["\'])(.*?)\1', re.IGNORECASE)
     LINES = [
         Line('Amarela', '\U0001F34B'),
         Line('Vermelha', '\U000FE051'),
@@ -50,72 +69,137 @@ class MLBot:
         self.state_file = state_file
         self.pretend = pretend
 
+        self.session = requests.Session()
+
         if not self.pretend:
+            import twitter
+
             self.twitter = twitter.Api(**twitter_config)
             self.twitter.VerifyCredentials()
         
         self.telegram_config = telegram_config
+        self.telegram_url = 'https://api.telegram.org/bot%s/sendMessage' % (
+            telegram_config['api_key'])
+        self.telegram_data = dict(parse_mode='HTML')
 
-        self.tz = pytz.timezone(self.TIMEZONE)
+        self.tz = ZoneInfo(self.TIMEZONE)
 
         self.log = logging.getLogger('mlbot')
 
+        self.state_encoder = msgspec.msgpack.Encoder()
+        self.state_decoder = msgspec.msgpack.Decoder(MLState)
+
         self.log.debug('Loading state from file')
         try:
             with open(self.state_file, 'rb') as f:
-                self.status = pickle.load(f)
+                state = self.state_decoder.decode(f.read())
         except FileNotFoundError:
             self.log.warning('File not found, first run?')
-            self.status = {}
+            state = MLState()
+        except msgspec.DecodeError:
+            self.log.warning('Invalid state file, starting over')
+            state = MLState()
+
+        self.status = state.status
+        self.etag = state.etag
+        self.last_modified = state.last_modified
 
     def check(self):
         """
         Check the status for changes
         """
+        validators = (self.etag, self.last_modified)
         status = self.get_status()
 
         # check for changes
-        for line, current in status.items():
-            last = self.status.get(line)
+        changed = False
+        try:
+            for line, current in status.items():
+                last = self.status.get(line)
 
-            if last == None:
-                self.state_change(line, current)
+                if last == None:
+                    self.state_change(line, current)
+                    changed = True
 
-            elif ((current.ok != last.ok)
-                or (not current.ok and current.message != last.message)):
+                elif ((current.ok != last.ok)
+                    or (not current.ok and current.message != last.message)):
 
-                self.state_change(line, current)
+                    self.state_change(line, current)
+                    changed = True
+        except Exception:
+            # publishing failed: forget the new validators, so that
+            # the next check downloads the page again instead of
+            # getting a 304 (parse failures never set them)
+            self.etag, self.last_modified = validators
+            raise
 
         # save state
+        if not changed and validators == (self.etag, self.last_modified):
+            self.log.debug('No changes, not saving state')
+            return
+
         self.log.debug('Saving state to file')
         self.status = status
+        state = MLState(
+            status=self.status,
+            etag=self.etag,
+            last_modified=self.last_modified)
         with open(self.state_file, 'wb') as f:
-            pickle.dump(self.status, f)
+            f.write(self.state_encoder.encode(state))
 
 
     def get_status(self):
         """
-        Downloads and parses status from the Metro website
+        Downloads and parses status from the Metro website.
+        If the page is unchanged since the last download,
+        the previous status is returned without parsing.
 
         :return: MLStatus object
         """
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+
         self.log.debug('Downloading HTML')
-        html = urlopen(self.STATUS_URL)
+        res = self.session.get(self.STATUS_URL, headers=headers, timeout=10)
 
+        if res.status_code == 304:
+            self.log.debug('Page not modified')
+            return self.status
+
+        res.raise_for_status()
+
+        # the page is small and the regex needs all of it, so the body
+        # is read in one go rather than streamed
         self.log.debug('Parsing HTML')
-        soup = BeautifulSoup(html, 'html.parser')
+        matches = {}
+        for m in self.STATUS_RE.finditer(res.content):
+            # keep the first cell for each line
+            matches.setdefault(m.group(2).lower().decode(), m)
+
         status = {}
 
         for line in self.LINES:
-            el = soup.select('td.linha_%s li' % line.name.lower())[0]
+            m = matches[line.key]
 
-            message = el.text
-            ok = 'semperturbacao' in el.parent.get('class', [])
+            message = html.unescape(
+                self.TAG_RE.sub(b'', m.group(4)).decode('utf-8'))
+            parent = m.group(3) if m.group(3) is not None else m.group(1)
+            classes = self.CLASS_RE.search(parent)
+            ok = (classes is not None and
+                b'semperturbacao' in classes.group(2).split())
 
             status[line.name] = MLStatus(
                 message=message,
                 ok=ok)
 
+        # only remember the validators once the page has been parsed,
+        # otherwise a bad response would be skipped with a 304
+        self.etag = res.headers.get('ETag')
+        self.last_modified = res.headers.get('Last-Modified')
+
         return status
 
     def state_change(self, line, status):
@@ -151,20 +235,35 @@ class MLBot:
     def publish_telegram(self, message):
         """
         Publishes a message to telegram.
-        
+        Destinations are sent to concurrently.
+
         :param message: Message to publish
         """
-        
-        key = self.telegram_config['api_key']
-        
-        for dst in self.telegram_config['destination']:
-            data = urlencode(dict(
-                chat_id=dst,
-                parse_mode='HTML',
-                text=message
-            )).encode('utf-8')
-                    
-            res = urlopen(f'https://api.telegram.org/bot{key}/sendMessage', data=data)
+        destinations = self.telegram_config['destination']
+        if not destinations:
+            return
+
+        # no more threads than the session keeps connections for,
+        # so none of them are discarded
+        workers = min(len(destinations), requests.adapters.DEFAULT_POOLSIZE)
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            # consume the results so that errors are raised here
+            list(pool.map(
+                lambda dst: self.send_telegram(dst, message),
+                destinations))
+
+    def send_telegram(self, dst, message):
+        """
+        Sends a message to a single telegram destination.
+
+        :param dst:     Channel/group name or ID
+        :param message: Message to send
+        """
+        data = dict(self.telegram_data, chat_id=dst, text=message)
+
+        res = self.session.post(self.telegram_url, data=data, timeout=10)
+        res.raise_for_status()
 
     def publish_twitter(self, message):
         """
@@ -174,58 +273,64 @@ class MLBot:
         """
 
         # add a timestamp to avoid duplicates
-        now = datetime.datetime.now()
-        now_tz = pytz.utc.localize(now).astimezone(self.tz)
-        timestamp = now_tz.strftime("[%H:%M]")
+        timestamp = datetime.datetime.now(self.tz).strftime("[%H:%M]")
 
         # split into tweets
         parts = []
         words = message.split(" ")
-        while len(words) > 0:
+        i = 0
+        while i < len(words):
             part = timestamp
 
-            while len(words) > 0:
-                joined = part + " " + words[0]
+            while i < len(words):
+                joined = part + " " + words[i]
                 if len(joined) < 270:
                     part = joined
-                    words.pop(0)
+                    i += 1
                 else:
                     break
 
             parts.append(part)
 
+        if self.pretend:
+            return
+
+        from twitter.error import TwitterError
+
         for part in parts:
-            try:
-                if not self.pretend:
+            for attempt in range(3):
+                try:
                     self.twitter.PostUpdate(part)
-                    
-            except TwitterError as e:
-                error = e.message
-                if (len(error) > 0 and
-                    error[0].get('code') == 187):
-
-                    # Duplicate? Add a dot.
-                    self.publish_twitter(message + '.')
-                else:
-                    raise e
+                    break
 
-if __name__ == '__main__':
+                except TwitterError as e:
+                    error = e.message
+                    if (attempt < 2 and
+                        len(error) > 0 and
+                        error[0].get('code') == 187):
+
+                        # Duplicate? Add a dot to this tweet and retry.
+                        part = part + '.'
+                    else:
+                        raise e
+
+def main():
     # set up logger
     logging.basicConfig(
         format="%(asctime)-15s %(levelname)-9s %(message)s")
-        
-        
+
     debug = os.environ.get('BOT_DEBUG', '0') == '1'
     pretend = os.environ.get('BOT_PRETEND', '0') == '1'
+    interval = int(os.environ.get('RUN_INTERVAL', '120'))
 
-    log = logging.getLogger('mlbot')    
+    log = logging.getLogger('mlbot')
     log.setLevel(logging.DEBUG if debug else logging.INFO)
 
     try:
         state_file = os.environ['BOT_STATE_FILE']
 
         bot = MLBot(
-            state_file, 
+            state_file,
             twitter_config=dict(
                 consumer_key=os.environ['TWITTER_CONSUMER_KEY'],
                 consumer_secret=os.environ['TWITTER_CONSUMER_SECRET'],
@@ -239,5 +344,28 @@ if __name__ == '__main__':
             pretend=pretend)
     except KeyError as e:
         log.critical('Environment variable %s not found.' % e)
-        
-    bot.check()
+        sys.exit(1)
+
+    from apscheduler.schedulers.blocking import BlockingScheduler
+
+    # run every interval in this process, skipping overlapping runs
+    scheduler = BlockingScheduler()
+    scheduler.add_job(
+        bot.check, 'interval',
+        seconds=interval,
+        next_run_time=datetime.datetime.now(),
+        max_instances=1,
+        coalesce=True)
+
+    # let a running check finish before quitting
+    def stop(signum, frame):
+        log.info('Stopping')
+        scheduler.shutdown()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    scheduler.start()
+
+if __name__ == '__main__':
+    main()